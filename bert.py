@@ -348,8 +348,8 @@ class BERTEncoder(nn.Module):
             # positions we want to attend and -10000.0 for masked positions.
             # Since we are adding it to the raw scores before the softmax, this is
             # effectively the same as removing these entirely.
-            extended_attention_mask = extended_attention_mask.float()
-            extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+            extended_attention_mask = torch.zeros_like(extended_attention_mask, dtype=torch.float).masked_fill_(
+                extended_attention_mask == 0, -10000.0)
 
             hidden_states = layer_module(hidden_states, extended_attention_mask)
             all_encoder_layers.append(hidden_states)
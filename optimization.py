@@ -38,6 +38,9 @@ def warmup_linear(x, warmup=0.002):
     return 1.0 - x
 
 
+# state kept in fp32 for bfloat16 parameters
+MASTER_STATE_KEYS = ('master_param', 'next_m', 'next_v')
+
 SCHEDULES = {
     'warmup_cosine': warmup_cosine,
     'warmup_constant': warmup_constant,
@@ -58,6 +61,7 @@ class BERTAdam(Optimizer):
         e: Adams epsilon. Default: 1e-6
         weight_decay_rate: Weight decay. Default: 0.01
         max_grad_norm: Maximum norm for the gradients (-1 means no clipping). Default: 1.0
+    Parameters in bfloat16 are updated through an fp32 master copy (and fp32 moments) kept in the optimizer state.
     """
 
     def __init__(self, params, lr, warmup=-1, t_total=-1, schedule='warmup_linear',
@@ -80,6 +84,19 @@ class BERTAdam(Optimizer):
                         max_grad_norm=max_grad_norm)
         super(BERTAdam, self).__init__(params, defaults)
 
+    def load_state_dict(self, state_dict):
+        super(BERTAdam, self).load_state_dict(state_dict)
+        # Optimizer.load_state_dict casts state to the parameter dtype; restore fp32 state of bfloat16 parameters
+        saved_ids = [i for group in state_dict['param_groups'] for i in group['params']]
+        params = [p for group in self.param_groups for p in group['params']]
+        for saved_id, p in zip(saved_ids, params):
+            if p.dtype != torch.bfloat16 or saved_id not in state_dict['state']:
+                continue
+            saved = state_dict['state'][saved_id]
+            for key in MASTER_STATE_KEYS:
+                if key in saved:
+                    self.state[p][key] = saved[key].to(device=p.device, dtype=torch.float32)
+
     def get_lr(self):
         lr = []
         for group in self.param_groups:
@@ -116,13 +133,19 @@ class BERTAdam(Optimizer):
 
                 state = self.state[p]
 
+                low_precision = p.data.dtype == torch.bfloat16
+                if low_precision and 'master_param' not in state:
+                    # fp32 master copy so that small updates are not rounded away
+                    state['master_param'] = p.data.float()
+                param = state['master_param'] if low_precision else p.data
+
                 # State initialization
-                if len(state) == 0:
+                if 'step' not in state:
                     state['step'] = 0
                     # Exponential moving average of gradient values
-                    state['next_m'] = torch.zeros_like(p.data)
+                    state['next_m'] = torch.zeros_like(param)
                     # Exponential moving average of squared gradient values
-                    state['next_v'] = torch.zeros_like(p.data)
+                    state['next_v'] = torch.zeros_like(param)
 
                 next_m, next_v = state['next_m'], state['next_v']
                 beta1, beta2 = group['b1'], group['b2']
@@ -130,6 +153,8 @@ class BERTAdam(Optimizer):
                 # Add grad clipping
                 if group['max_grad_norm'] > 0:
                     clip_grad_norm_(p, group['max_grad_norm'])
+                if low_precision:
+                    grad = grad.float()
 
                 # Decay the first and second moment running average coefficient
                 # In-place operations to update the averages at the same time
@@ -145,7 +170,7 @@ class BERTAdam(Optimizer):
                 # with the m/v parameters. This is equivalent to adding the square
                 # of the weights to the loss with plain (non-momentum) SGD.
                 if group['weight_decay_rate'] > 0.0:
-                    update += group['weight_decay_rate'] * p.data
+                    update += group['weight_decay_rate'] * param
 
                 if group['t_total'] != -1:
                     schedule_fct = SCHEDULES[group['schedule']]
@@ -154,7 +179,9 @@ class BERTAdam(Optimizer):
                     lr_scheduled = group['lr']
 
                 update_with_lr = lr_scheduled * update
-                p.data.add_(-update_with_lr)
+                param.add_(-update_with_lr)
+                if low_precision:
+                    p.data.copy_(param)
 
                 state['step'] += 1
 
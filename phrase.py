@@ -1,9 +1,40 @@
+import contextlib
+import functools
+import logging
+
 import torch
 from torch import nn
-from torch.nn.functional import binary_cross_entropy_with_logits, embedding
+from torch.nn.functional import binary_cross_entropy_with_logits, one_hot
 
 from bert import BertModel, BERTLayerNorm, SparseAttention
 
+logger = logging.getLogger(__name__)
+
+
+def _compile(fn):
+    """
+    Fuses `fn` with torch.compile when available (torch>=2.0).
+    Falls back to eager on older torch, or when compilation fails (e.g. no Inductor/Triton/C++ toolchain).
+    Runtime errors (OOM, shape/dtype mismatches) propagate unchanged.
+    """
+    if not hasattr(torch, 'compile'):
+        return fn
+    from torch._dynamo.exc import TorchDynamoException  # BackendCompilerFailed and friends derive from it
+    compiled = torch.compile(fn, fullgraph=True, dynamic=True)
+    state = {'eager': False}
+
+    @functools.wraps(fn)
+    def wrapper(*args):
+        if not state['eager']:
+            try:
+                return compiled(*args)
+            except TorchDynamoException as e:
+                logger.warning('torch.compile failed for %s; running eagerly: %s', fn.__name__, e)
+                state['eager'] = True
+        return fn(*args)
+
+    return wrapper
+
 
 class BertWrapper(nn.Module):
     """
@@ -21,12 +52,19 @@ class BertWrapper(nn.Module):
         return layers[-1]
 
 
-def encode_phrase(layer, phrase_size, span_kq_size=64, get_first_only=False):
+def split_phrase(layer, phrase_size, span_kq_size=64):
     assert phrase_size - 1 <= layer.size(2) - span_kq_size, "phrase size too big"
-    boundary_layer = layer[:, :, :phrase_size - 1]
-    span_layer = layer[:, :, -span_kq_size:]
-    start, end = boundary_layer.chunk(2, dim=2)
-    span_start, span_end = span_layer.chunk(2, dim=2)
+    assert (phrase_size - 1) % 2 == 0, "phrase size - 1 must be even to split into start and end"
+    boundary_size = (phrase_size - 1) // 2
+    unused_size = layer.size(2) - 2 * boundary_size - span_kq_size
+    # [start | end | unused | span_start | span_end] as views in one call
+    start, end, _, span_start, span_end = layer.split(
+        [boundary_size, boundary_size, unused_size, span_kq_size // 2, span_kq_size // 2], dim=2)
+    return start, end, span_start, span_end
+
+
+def encode_phrase(layer, phrase_size, span_kq_size=64, get_first_only=False):
+    start, end, span_start, span_end = split_phrase(layer, phrase_size, span_kq_size=span_kq_size)
     span_logits = span_start.matmul(span_end.transpose(1, 2))
     if get_first_only:
         start = start[:, :1, :]
@@ -35,15 +73,59 @@ def encode_phrase(layer, phrase_size, span_kq_size=64, get_first_only=False):
     return start, end, span_logits
 
 
+@_compile
+def _l2_logits(a, b):
+    # a.b - 0.5 * (a.a + b.b) in one pass over a and b
+    return -0.5 * ((a - b) ** 2).sum(-1)
+
+
 def get_logits(a, b, metric):
     if metric == 'ip':
+        if a.dim() == 3 and b.dim() == 3 and b.size(1) == 1:
+            # [B, L, D] against a single [B, 1, D] query vector is a batched GEMV
+            return a.matmul(b.transpose(1, 2)).squeeze(-1)
+        if hasattr(torch.linalg, 'vecdot'):
+            return torch.linalg.vecdot(a, b, dim=-1)
         return (a * b).sum(-1)
     elif metric == 'l2':
-        return get_logits(a, b, 'ip') - 0.5 * (get_logits(a, a, 'ip') + get_logits(b, b, 'ip'))
+        return _l2_logits(a, b)
     else:
         raise ValueError(metric)
 
 
+@_compile
+def _assemble_logits(start_logits, end_logits, cross_logits):
+    # fused into a single kernel that reads each input once
+    return start_logits.unsqueeze(2) + end_logits.unsqueeze(1) + cross_logits  # [B, L, L]
+
+
+@_compile
+def _axis_means(all_logits):
+    # all_logits.mean(2) and all_logits.mean(1) in one fused helper, accumulated in fp32 whatever the input dtype
+    start_means = all_logits.sum(2, dtype=torch.float32) / all_logits.size(2)
+    end_means = all_logits.sum(1, dtype=torch.float32) / all_logits.size(1)
+    return start_means, end_means
+
+
+@_compile
+def _span_target(start_positions, end_positions, length):
+    # positions are clamped to [-1, L]; -1 (no answer) maps to the default class and L to the ignored index
+    valid = (start_positions < length) & (end_positions < length)
+    span_target = (start_positions * length + end_positions).clamp(min=-1)
+    return torch.where(valid, span_target, torch.full_like(span_target, length ** 2))
+
+
+def get_ip_all_logits(start_logits, end_logits, span_start, span_end, q_span_logits):
+    # start_logits[:, i] + end_logits[:, j] + q_span_logits * (span_start[:, i] . span_end[:, j]) as a single bmm
+    # over vectors augmented with [start_logit, 1] and [1, end_logit], so [B, L, L] is written only once
+    ones = torch.ones_like(start_logits).unsqueeze(2)
+    # zero columns pad the inner dim (e.g. 34 -> 40) to a multiple of 8 for the tensor-core path
+    pad = start_logits.new_zeros(start_logits.size() + (-(span_start.size(2) + 2) % 8,))
+    left = torch.cat([span_start * q_span_logits, start_logits.unsqueeze(2), ones, pad], 2)
+    right = torch.cat([span_end, ones, end_logits.unsqueeze(2), pad], 2)
+    return left.matmul(right.transpose(1, 2))  # [B, L, L]
+
+
 def get_sparse_logits(a, b, a_id, b_id, a_mask, ngrams=['1']):
     logits = 0.0
     if '1' in ngrams:
@@ -75,8 +157,12 @@ def get_sparse_logits(a, b, a_id, b_id, a_mask, ngrams=['1']):
     return logits
 
 
+def _to_float(*tensors):
+    return tuple(None if t is None else t.float() for t in tensors)
+
+
 class PhraseModel(nn.Module):
-    def __init__(self, encoder, sparse_layer, phrase_size, metric):
+    def __init__(self, encoder, sparse_layer, phrase_size, metric, use_bf16=False):
         super(PhraseModel, self).__init__()
         self.encoder = encoder
         self.sparse_layer = sparse_layer
@@ -85,56 +171,101 @@ class PhraseModel(nn.Module):
         self.default_value = nn.Parameter(torch.randn(1))
         self.filter = BoundaryFilter(self.boundary_size)
         self.metric = metric
+        self.use_bf16 = use_bf16
+
+    def _autocast(self):
+        # Encoder and phrase scoring run in bf16; losses are computed outside in fp32
+        if not self.use_bf16:
+            # torch 1.10 checks bf16 device support even when disabled; contextlib.suppress() is py3.6's null context
+            return contextlib.suppress()
+        return torch.autocast(device_type='cuda', dtype=torch.bfloat16)
+
+    def _encode(self, *inputs):
+        # inputs are (ids, mask) pairs with ids possibly None; same-length inputs share one batched encoder pass
+        layers = [None] * len(inputs)
+        groups = {}
+        for i, (ids, _) in enumerate(inputs):
+            if ids is not None:
+                groups.setdefault(ids.size(1), []).append(i)
+        for idxs in groups.values():
+            if len(idxs) == 1:
+                layers[idxs[0]] = self.encoder(*inputs[idxs[0]])
+                continue
+            ids = torch.cat([inputs[i][0] for i in idxs], 0)
+            mask = torch.cat([inputs[i][1] for i in idxs], 0)
+            outs = self.encoder(ids, mask).split([inputs[i][0].size(0) for i in idxs], 0)
+            for i, out in zip(idxs, outs):
+                layers[i] = out
+        return layers
 
     def forward(self,
                 context_ids=None, context_mask=None,
                 query_ids=None, query_mask=None,
                 start_positions=None, end_positions=None,
                 neg_context_ids=None, neg_context_mask=None):
+        if context_ids is None:
+            neg_context_ids = None
+        if neg_context_ids is not None:
+            assert neg_context_mask is not None
+        with self._autocast():
+            context_layer, context_layer2, question_layer = self._encode((context_ids, context_mask),
+                                                                         (neg_context_ids, neg_context_mask),
+                                                                         (query_ids, query_mask))
+
         if context_ids is not None:
-            context_layer = self.encoder(context_ids, context_mask)
-            if neg_context_ids is not None:
-                assert neg_context_mask is not None
-                context_layer2 = self.encoder(neg_context_ids, neg_context_mask)
-                context_layer = torch.cat([context_layer, context_layer2], 1)
-            start, end, span_logits = encode_phrase(context_layer, self.phrase_size)
-            # print(start.min(), start.max(), end.min(), end.max())
-            start_filter_logits, end_filter_logits = self.filter(start, end)
-            sparse = None
-            if self.sparse_layer is not None:
-                sparse = self.sparse_layer(
-                    context_layer,
-                    (1 - context_mask).float() * -1e9
-                )[:, :, 0, :]
+            with self._autocast():
+                if neg_context_ids is not None:
+                    context_layer = torch.cat([context_layer, context_layer2], 1)
+                start, end, span_start, span_end = split_phrase(context_layer, self.phrase_size)
+                # span_logits are only returned when embedding context
+                if query_ids is None:
+                    span_logits = span_start.matmul(span_end.transpose(1, 2))
+                # print(start.min(), start.max(), end.min(), end.max())
+                start_filter_logits, end_filter_logits = self.filter(start, end)
+                sparse = None
+                if self.sparse_layer is not None:
+                    sparse = self.sparse_layer(
+                        context_layer,
+                        torch.zeros_like(context_mask, dtype=torch.float).masked_fill_(context_mask == 0, -1e9)
+                    )[:, :, 0, :]
 
             # embed context
             if query_ids is None:
-                return start, end, span_logits, start_filter_logits, end_filter_logits, sparse
+                return _to_float(start, end, span_logits, start_filter_logits, end_filter_logits, sparse)
 
         if query_ids is not None:
-            question_layer = self.encoder(query_ids, query_mask)
-            query_start, query_end, q_span_logits = encode_phrase(question_layer, self.phrase_size,
-                                                                  get_first_only=True)
-            query_sparse = None
-            if self.sparse_layer is not None:
-                query_sparse = self.sparse_layer(
-                    question_layer,
-                    (1 - query_mask).float() * -1e9
-                )[:, 0, 0, :]
+            with self._autocast():
+                query_start, query_end, q_span_logits = encode_phrase(question_layer, self.phrase_size,
+                                                                      get_first_only=True)
+                query_sparse = None
+                if self.sparse_layer is not None:
+                    query_sparse = self.sparse_layer(
+                        question_layer,
+                        torch.zeros_like(query_mask, dtype=torch.float).masked_fill_(query_mask == 0, -1e9)
+                    )[:, 0, 0, :]
 
             # embed question
             if context_ids is None:
-                return query_start, query_end, q_span_logits, query_sparse
+                return _to_float(query_start, query_end, q_span_logits, query_sparse)
 
         # pass this line only if train or eval
-        start_logits = get_logits(start, query_start, self.metric)
-        end_logits = get_logits(end, query_end, self.metric)
-        cross_logits = get_logits(span_logits.unsqueeze(-1), q_span_logits.unsqueeze(-1), self.metric)
-        all_logits = start_logits.unsqueeze(2) + end_logits.unsqueeze(1) + cross_logits  # [B, L, L]
-        # exp_mask = -1e9 * (1.0 - (context_mask.unsqueeze(1) & context_mask.unsqueeze(-1)).float())
-        if self.sparse_layer is not None:
-            sparse_logits = get_sparse_logits(sparse, query_sparse, context_ids, query_ids, context_mask)
-            all_logits += sparse_logits.unsqueeze(2)
+        with self._autocast():
+            start_logits = get_logits(start, query_start, self.metric)
+            end_logits = get_logits(end, query_end, self.metric)
+            if self.metric == 'ip':
+                all_logits = get_ip_all_logits(start_logits, end_logits, span_start, span_end, q_span_logits)
+            else:
+                # l2 between scalars, without building a size-1 axis to sum over
+                span_logits = span_start.matmul(span_end.transpose(1, 2))
+                cross_logits = -0.5 * (span_logits - q_span_logits) ** 2
+                all_logits = _assemble_logits(start_logits, end_logits, cross_logits)
+            # exp_mask = -1e9 * (1.0 - (context_mask.unsqueeze(1) & context_mask.unsqueeze(-1)).float())
+            if self.sparse_layer is not None:
+                sparse_logits = get_sparse_logits(sparse, query_sparse, context_ids, query_ids, context_mask)
+                all_logits += sparse_logits.unsqueeze(2)
+        # the help loss reduces all_logits in its compute dtype (bf16 under autocast) before the upcast
+        mean_logits = all_logits
+        all_logits = all_logits.float()
         # all_logits = all_logits + exp_mask
 
         if start_positions is not None and end_positions is not None:
@@ -146,24 +277,21 @@ class PhraseModel(nn.Module):
             # sometimes the start/end positions are outside our model inputs, we ignore these terms
             ignored_index = start_logits.size(1)
             span_ignored_index = ignored_index ** 2
-            start_positions.clamp_(-1, ignored_index)
-            end_positions.clamp_(-1, ignored_index)
+            start_positions = start_positions.clamp(-1, ignored_index)
+            end_positions = end_positions.clamp(-1, ignored_index)
 
             cel_1d = CrossEntropyLossWithDefault(default_value=self.default_value,
                                                  ignore_index=ignored_index)
             cel_2d = CrossEntropyLossWithDefault(default_value=self.default_value,
                                                  ignore_index=span_ignored_index)
 
-            span_target = start_positions * ignored_index + end_positions
-            # needed to handle -1
-            span_target.clamp_(-1, span_ignored_index)
-            valid = (start_positions < ignored_index) & (end_positions < ignored_index)
-            span_target = valid.long() * span_target + (1 - valid.long()) * span_ignored_index
+            span_target = _span_target(start_positions, end_positions, ignored_index)
 
             true_loss = cel_2d(all_logits.view(all_logits.size(0), -1), span_target)
 
-            help_loss = 0.5 * (cel_1d(all_logits.mean(2), start_positions) +
-                               cel_1d(all_logits.mean(1), end_positions))
+            start_means, end_means = _axis_means(mean_logits)
+            help_loss = 0.5 * (cel_1d(start_means, start_positions) +
+                               cel_1d(end_means, end_positions))
 
             loss = true_loss + help_loss
 
@@ -171,20 +299,21 @@ class PhraseModel(nn.Module):
             # if self.sparse_layer is not None:
             #     loss = cel_1d(sparse_logits, start_positions)
 
-            filter_loss = self.filter(start, end, start_positions=start_positions, end_positions=end_positions)
+            with self._autocast():
+                filter_loss = self.filter(start, end, start_positions=start_positions, end_positions=end_positions)
 
             return loss, filter_loss
         else:
-            return all_logits, start_filter_logits, end_filter_logits
+            return all_logits, start_filter_logits.float(), end_filter_logits.float()
 
 
 class BertPhraseModel(PhraseModel):
-    def __init__(self, config, phrase_size, metric, use_sparse):
+    def __init__(self, config, phrase_size, metric, use_sparse, use_bf16=False):
         encoder = BertWrapper(BertModel(config))
         sparse_layer = None
         if use_sparse:
             sparse_layer = SparseAttention(config, num_sparse_heads=1)
-        super(BertPhraseModel, self).__init__(encoder, sparse_layer, phrase_size, metric)
+        super(BertPhraseModel, self).__init__(encoder, sparse_layer, phrase_size, metric, use_bf16=use_bf16)
 
         def init_weights(module):
             if isinstance(module, (nn.Linear, nn.Embedding)):
@@ -205,16 +334,35 @@ class CrossEntropyLossWithDefault(nn.CrossEntropyLoss):
         if ignore_index >= 0:
             ignore_index += 1
         super(CrossEntropyLossWithDefault, self).__init__(ignore_index=ignore_index, **kwargs)
+        # forward computes the loss itself, so these nn.CrossEntropyLoss options would be ignored
+        assert self.weight is None, "weight is not supported"
+        assert getattr(self, 'label_smoothing', 0.0) == 0.0, "label_smoothing is not supported"
         self.default_value = default_value
 
     def forward(self, input_, target):
         assert len(input_.size()) == 2
-        default_value = self.default_value.unsqueeze(0).repeat(input_.size(0), 1)
-        new_input = torch.cat([default_value, input_], 1)
         new_target = target + 1
         assert new_target.min().item() >= 0, (new_target.min().item(), target.min().item())
-        loss = super(CrossEntropyLossWithDefault, self).forward(new_input, new_target)
-        return loss
+        # cross entropy over [default_value, input_] without concatenating a [B, C + 1] input:
+        # the log-partition adds the default logit to logsumexp, and target -1 picks the default logit
+        log_z = torch.logaddexp(torch.logsumexp(input_, 1), self.default_value)
+        target_logits = input_.gather(1, target.clamp(0, input_.size(1) - 1).unsqueeze(1)).squeeze(1)
+        target_logits = torch.where(target < 0, self.default_value, target_logits)
+        keep = new_target != self.ignore_index
+        loss = (log_z - target_logits).masked_fill(~keep, 0.0)
+        if self.reduction == 'none':
+            return loss
+        if self.reduction == 'sum':
+            return loss.sum()
+        return loss.sum() / keep.sum()
+
+
+def _one_hot(positions, logits):
+    # positions outside [0, L) (-1 or L after clamping) give an all-zero target
+    length = logits.size(1)
+    valid = (positions >= 0) & (positions < length)
+    target = one_hot(positions.clamp(0, length - 1), num_classes=length)
+    return target.masked_fill_(~valid.unsqueeze(1), 0).to(logits.dtype)
 
 
 class BoundaryFilter(nn.Module):
@@ -230,15 +378,15 @@ class BoundaryFilter(nn.Module):
             return start_logits, end_logits
 
         ignored_index = start_logits.size(1)
-        start_positions.clamp_(-1, ignored_index)
-        end_positions.clamp_(-1, ignored_index)
-
-        device = start_logits.device
-        length = torch.tensor(start_logits.size(1)).to(device)
-        eye = torch.eye(length + 2).to(device)
-        start_1hot = embedding(start_positions + 1, eye)[:, 1:-1]
-        end_1hot = embedding(end_positions + 1, eye)[:, 1:-1]
-        start_loss = binary_cross_entropy_with_logits(start_logits, start_1hot, pos_weight=length)
-        end_loss = binary_cross_entropy_with_logits(end_logits, end_1hot, pos_weight=length)
+        start_positions = start_positions.clamp(-1, ignored_index)
+        end_positions = end_positions.clamp(-1, ignored_index)
+
+        # pos_weight has to be a tensor; filling it on device avoids a host-to-device copy per step.
+        # Kept in fp32 so L is not rounded when the logits are bf16 under autocast.
+        pos_weight = start_logits.new_full((), float(ignored_index), dtype=torch.float32)
+        start_1hot = _one_hot(start_positions, start_logits)
+        end_1hot = _one_hot(end_positions, end_logits)
+        start_loss = binary_cross_entropy_with_logits(start_logits, start_1hot, pos_weight=pos_weight)
+        end_loss = binary_cross_entropy_with_logits(end_logits, end_1hot, pos_weight=pos_weight)
         loss = 0.5 * start_loss + 0.5 * end_loss
         return loss
@@ -196,7 +196,7 @@ def get_metadata(id2example, features, results, max_answer_length, do_lower_case
                          for feature, result in zip(features, results)],
                         axis=0)
 
-    span_logits = np.zeros([np.shape(start)[0], max_answer_length], dtype=start.dtype)
+    span_logits = np.zeros([np.shape(start)[0], max_answer_length], dtype=results[0].span_logits.dtype)
     start2end = -1 * np.ones([np.shape(start)[0], max_answer_length], dtype=np.int32)
     idx = 0
     for feature, result in zip(features, results):
@@ -263,7 +263,8 @@ def filter_metadata(metadata, threshold):
 
 def compress_metadata(metadata, offset, scale):
     for key in ['start', 'end']:
-        if key in metadata:
+        # skip vectors that were already quantized on device
+        if key in metadata and metadata[key].dtype != np.int8:
             metadata[key] = float_to_int8(metadata[key], offset, scale)
     return metadata
 
@@ -576,3 +577,10 @@ def float_to_int8(num, offset, factor):
     out = out.clip(-128, 127)
     out = np.round(out).astype(np.int8)
     return out
+
+
+def tensor_float_to_int8(num, offset, factor):
+    out = (num - offset) * factor
+    out = out.clamp(-128, 127)
+    out = out.round().to(torch.int8)
+    return out
@@ -26,7 +26,7 @@ from phrase import BertPhraseModel
 from pre import convert_examples_to_features, read_squad_examples, convert_documents_to_features, \
     convert_questions_to_features, SquadExample, inject_noise_to_neg_features_list, sample_similar_questions
 from post import write_predictions, write_hdf5, get_question_results as get_question_results_, \
-    convert_question_features_to_dataloader, write_question_results
+    convert_question_features_to_dataloader, write_question_results, tensor_float_to_int8
 from serve import serve
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
@@ -138,6 +138,15 @@ def main():
                         default=False,
                         action='store_true',
                         help="Whether to use 16-bit float precision instead of 32-bit")
+    parser.add_argument('--bf16',
+                        default=False,
+                        action='store_true',
+                        help="Whether to run the encoder and phrase scoring under bfloat16 autocast")
+    parser.add_argument('--bf16_weights',
+                        default=False,
+                        action='store_true',
+                        help="Whether to keep the BERT encoder weights in bfloat16 (implies --bf16); "
+                             "BERTAdam keeps fp32 master copies")
 
     # Training options: only effective during training
     parser.add_argument("--learning_rate", default=3e-5, type=float, help="The initial learning rate for Adam.")
@@ -272,13 +281,17 @@ def main():
     else:
         os.makedirs(args.output_dir, exist_ok=True)
 
+    if args.bf16_weights:
+        args.bf16 = True
+
     tokenizer = tokenization.FullTokenizer(vocab_file=args.vocab_file, do_lower_case=not args.do_case)
 
     model = BertPhraseModel(
         bert_config,
         phrase_size=args.phrase_size,
         metric=args.metric,
-        use_sparse=args.use_sparse
+        use_sparse=args.use_sparse,
+        use_bf16=args.bf16
     )
 
     print('Number of model parameters:', sum(p.numel() for p in model.parameters()))
@@ -294,6 +307,9 @@ def main():
     if args.fp16:
         model.half()
 
+    if args.bf16_weights:
+        model.encoder.to(torch.bfloat16)
+
     if not args.optimize_on_cpu:
         model.to(device)
 
@@ -756,9 +772,18 @@ def main():
                     with torch.no_grad():
                         batch_start, batch_end, batch_span_logits, bs, be, batch_sparse = model(input_ids,
                                                                                                 input_mask)
+                        if args.compression_offset is not None:
+                            # quantize before copying to host; write_hdf5 keeps int8 vectors as they are
+                            batch_start = tensor_float_to_int8(batch_start, args.compression_offset,
+                                                               args.compression_scale)
+                            batch_end = tensor_float_to_int8(batch_end, args.compression_offset,
+                                                             args.compression_scale)
                     for i, example_index in enumerate(example_indices):
-                        start = batch_start[i].detach().cpu().numpy().astype(args.dtype)
-                        end = batch_end[i].detach().cpu().numpy().astype(args.dtype)
+                        start = batch_start[i].detach().cpu().numpy()
+                        end = batch_end[i].detach().cpu().numpy()
+                        if args.compression_offset is None:
+                            start = start.astype(args.dtype)
+                            end = end.astype(args.dtype)
                         sparse = None
                         if batch_sparse is not None:
                             sparse = batch_sparse[i].detach().cpu().numpy().astype(args.dtype)